@@ -0,0 +1,164 @@
+"""Local stand-ins for the Telegram Bot API and the Google Sheets values API.
+
+Both servers speak just enough HTTP/1.1 (with keep-alive) for PTB's httpx client and
+googleapiclient's httplib2 transport, and add a configurable latency to every request.
+"""
+import asyncio
+import json
+import time
+from collections import Counter
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class FakeHttpServer:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.server = None
+        self.port = None
+        self.connections = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        # Keep-alive connections outlive close(); end them so nothing is left pending at exit
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                status, payload = await self.handle(method, target, headers, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+                    + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def handle(self, method, target, headers, body):
+        raise NotImplementedError
+
+
+class FakeBotApi(FakeHttpServer):
+    """Answers /bot<token>/<method> like the Bot API, without any flood limits."""
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.message_ids = 0
+
+    async def handle(self, method, target, headers, body):
+        api_method = urlsplit(target).path.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params = self.parse_params(headers, body)
+
+        if api_method == "getUpdates":
+            # Behave like a long poll that times out with nothing new
+            await asyncio.sleep(min(float(params.get("timeout", 0)), 1.0))
+            result = []
+        elif api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif api_method in ("sendMessage", "editMessageText"):
+            self.message_ids += 1
+            result = {
+                "message_id": int(params.get("message_id", self.message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return "200 OK", {"ok": True, "result": result}
+
+    @staticmethod
+    def parse_params(headers, body):
+        if not body:
+            return {}
+        if headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body)
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+
+class FakeSheets(FakeHttpServer):
+    """Serves values.get/batchGet with generated KYC rows, values.append/batchUpdate, and an OAuth token endpoint."""
+
+    STATUSES = ["VERIFIED", "REJECTED", ""]
+
+    def __init__(self, latency=0.0, rows=1000):
+        super().__init__(latency)
+        self.rows = rows
+        self.cells = {}  # (sheet, row number) -> cells from column B written by batchUpdate
+
+    def range_values(self, sheet_range):
+        sheet, _, cells = sheet_range.partition("!")
+        values = [["Username", "Status", "Reason", "Date"]]
+        for i in range(self.rows):
+            status = self.STATUSES[i % len(self.STATUSES)]
+            values.append([f"@{sheet.lower()}_{i}", status, "Bench reason" if status else "", "2024-01-01"])
+        for (written_sheet, row_number), written in self.cells.items():
+            if written_sheet == sheet and row_number <= len(values):
+                values[row_number - 1][1:1 + len(written)] = written
+        if cells.startswith("A") and cells[1:].isdigit():
+            # Single cell, e.g. "New_User!A12"
+            row_number = int(cells[1:])
+            values = [values[row_number - 1][:1]] if row_number <= len(values) else []
+        return {"range": sheet_range, "majorDimension": "ROWS", "values": values}
+
+    async def handle(self, method, target, headers, body):
+        parts = urlsplit(target)
+        query = parse_qs(parts.query)
+        if parts.path == "/token":
+            self.calls["token"] += 1
+            return "200 OK", {"access_token": "bench", "token_type": "Bearer", "expires_in": 3600}
+        if parts.path.endswith("/values:batchGet"):
+            self.calls["batchGet"] += 1
+            return "200 OK", {"valueRanges": [self.range_values(r) for r in query.get("ranges", [])]}
+        if parts.path.endswith("/values:batchUpdate"):
+            self.calls["batchUpdate"] += 1
+            data = json.loads(body).get("data", [])
+            for value_range in data:
+                # Only single-row ranges starting at column B, which is all the bot writes
+                sheet, cells = value_range["range"].split("!", 1)
+                row_number = int(cells.split(":", 1)[0].lstrip("B"))
+                self.cells[(sheet, row_number)] = value_range["values"][0]
+            return "200 OK", {"totalUpdatedRows": len(data)}
+        if parts.path.endswith(":append"):
+            self.calls["append"] += 1
+            rows = json.loads(body).get("values", [])
+            return "200 OK", {"updates": {"updatedRows": len(rows)}}
+        if "/values/" in parts.path:
+            self.calls["get"] += 1
+            return "200 OK", self.range_values(unquote(parts.path.rsplit("/values/", 1)[1]))
+        return "404 Not Found", {"error": {"code": 404, "message": "Not found"}}
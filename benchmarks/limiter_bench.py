@@ -0,0 +1,77 @@
+"""Microbenchmark for MessageLimiter: checks/sec, slowest single check and RSS as the tracked
+user count grows, then again after the clock moves past a period so idle users are evicted.
+
+Usage: python benchmarks/limiter_bench.py [--max-users 1000000] [--checks 200000] [--active-users 1000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import MessageLimiter
+
+# The limiter reads time.monotonic(); shifting it lets the bench cross a period without waiting
+clock_offset = [0.0]
+real_monotonic = time.monotonic
+time.monotonic = lambda: real_monotonic() + clock_offset[0]
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def timed_checks(limiter, ids):
+    slowest = 0.0
+    started = time.perf_counter()
+    for user_id in ids:
+        before = time.perf_counter()
+        limiter.check_limit(user_id)
+        slowest = max(slowest, time.perf_counter() - before)
+    return time.perf_counter() - started, slowest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-users", type=int, default=1_000_000)
+    parser.add_argument("--checks", type=int, default=200_000)
+    parser.add_argument("--active-users", type=int, default=1000, help="users still sending after the idle period")
+    args = parser.parse_args()
+
+    limiter = MessageLimiter(max_messages=3, period_seconds=60)
+    baseline_rss = rss_mb()
+    print(f"{'users':>10} {'checks/sec':>12} {'max check ms':>13} {'rss MB':>9} {'bytes/user':>11}")
+
+    populated = 0
+    user_count = 1000
+    while user_count <= args.max_users:
+        _, slowest = timed_checks(limiter, range(populated, user_count))
+        populated = user_count
+
+        elapsed, slowest_random = timed_checks(limiter, [random.randrange(user_count) for _ in range(args.checks)])
+        rss = rss_mb()
+        per_user = (rss - baseline_rss) * 1024 * 1024 / user_count
+        print(f"{user_count:>10} {args.checks / elapsed:>12,.0f} {max(slowest, slowest_random) * 1000:>13.3f} "
+              f"{rss:>9.1f} {per_user:>11.0f}")
+        user_count *= 10
+
+    # Everyone else goes quiet while a small set of users keeps sending; buckets idle for a whole
+    # period are dropped at the second period boundary and freed a few at a time after that
+    print()
+    for period in (1, 2):
+        clock_offset[0] += limiter.period_seconds + 1
+        tracked_before = limiter.tracked_users()
+        elapsed, slowest = timed_checks(limiter, [random.randrange(args.active_users) for _ in range(args.checks)])
+        print(f"after idle period {period}: {args.checks / elapsed:,.0f} checks/sec, max check {slowest * 1000:.3f} ms, "
+              f"tracked users {tracked_before:,} -> {limiter.tracked_users():,}, "
+              f"retired left {sum(map(len, limiter.retired)):,}, rss {rss_mb():.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
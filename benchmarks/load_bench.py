@@ -0,0 +1,224 @@
+"""Offline load test: replay synthetic update streams through main.py's update pipeline.
+
+Updates go into the application's update_queue, the same path polling and the webhook use,
+so queue backpressure and per-user ordering are part of what is measured. Telegram and
+Google Sheets are replaced by the local fakes in benchmarks/fakes.py, so nothing leaves
+the machine. Reports end-to-end p50/p99 (enqueue to handled) per update type, handler
+time from main's handler_latency histogram, and updates/sec.
+
+Usage: python benchmarks/load_bench.py [--users 500] [--refresh-taps 5] [--bot-latency 20]
+       [--sheets-latency 150] [--rows 5000] [--scenario all|start|refresh|contact]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeBotApi, FakeSheets
+
+update_ids = itertools.count(1)
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"new_user_{user_id}"}
+
+
+def message_update(user_id, text):
+    update_id = next(update_ids)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(user_id, data):
+    update_id = next(update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bench"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def start_storm(users):
+    return [("start", message_update(uid, "/start")) for uid in users]
+
+
+def refresh_spam(users, taps):
+    return [("kyc_check", callback_update(uid, "kyc_check_new")) for _ in range(taps) for uid in users]
+
+
+def contact_burst(users):
+    stream = [("contact_admin", callback_update(uid, "contact_admin")) for uid in users]
+    stream += [("handle_user_message", message_update(uid, f"Hello admin, this is {uid}")) for uid in users]
+    return stream
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def handler_snapshot(main):
+    return {labels[0]: (list(counts), total, count) for labels, (counts, total, count) in main.handler_latency.values.items()}
+
+
+def handler_times(main, before):
+    # Per handler over this scenario: calls, mean, and the histogram bucket holding the p99
+    results = {}
+    for name, (counts, total, count) in handler_snapshot(main).items():
+        old_counts, old_total, old_count = before.get(name, ([0] * len(counts), 0.0, 0))
+        calls = count - old_count
+        if not calls:
+            continue
+        deltas = [new - old for new, old in zip(counts, old_counts)]
+        cumulative, p99_bound = 0, float("inf")
+        for bound, bucket_count in zip(main.handler_latency.buckets + (float("inf"),), deltas):
+            cumulative += bucket_count
+            if cumulative >= 0.99 * calls:
+                p99_bound = bound
+                break
+        results[name] = (calls, (total - old_total) / calls, p99_bound)
+    return results
+
+
+async def replay(main, app, stream):
+    latencies = defaultdict(list)
+    enqueued = {}
+    process_update = app.process_update
+
+    async def timed_process_update(update):
+        # PTB's update fetcher calls this for every update it takes off the queue
+        try:
+            await process_update(update)
+        finally:
+            label, queued_at = enqueued.pop(update.update_id)
+            latencies[label].append(time.perf_counter() - queued_at)
+
+    app.process_update = timed_process_update
+    before = handler_snapshot(main)
+    started = time.perf_counter()
+    try:
+        for label, data in stream:
+            update = main.Update.de_json(data, app.bot)
+            enqueued[update.update_id] = (label, time.perf_counter())
+            # Blocks when the pipeline is full, like polling does
+            await app.update_queue.put(update)
+        await app.update_queue.join()
+    finally:
+        app.process_update = process_update
+    handled = time.perf_counter() - started
+    await main.outbound.drain()
+    drained = time.perf_counter() - started
+    return latencies, handler_times(main, before), handled, drained
+
+
+def report(name, latencies, handlers, handled, drained, count):
+    print(f"\n== {name}: {count} updates, {count / handled:,.0f} updates/sec handled, "
+          f"{drained:.2f}s until all outbound messages were sent")
+    print(f"{'end-to-end':<22} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for label, samples in latencies.items():
+        print(f"{label:<22} {len(samples):>7} {percentile(samples, 0.5) * 1000:>9.2f} "
+              f"{percentile(samples, 0.99) * 1000:>9.2f} {max(samples) * 1000:>9.2f}")
+    print(f"{'handler time':<22} {'count':>7} {'mean ms':>9} {'p99 <= ms':>9}")
+    for label, (calls, mean, p99_bound) in handlers.items():
+        print(f"{label:<22} {calls:>7} {mean * 1000:>9.2f} {p99_bound * 1000:>9.0f}")
+
+
+async def run(args):
+    bot_api = await FakeBotApi(latency=args.bot_latency / 1000).start()
+    sheets = await FakeSheets(latency=args.sheets_latency / 1000, rows=args.rows).start()
+
+    # main reads its configuration at import time
+    workdir = tempfile.mkdtemp(prefix="odvut-bench-")
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCH",
+        "BOT_API_URL": bot_api.url,
+        "SHEETS_API_ENDPOINT": sheets.url + "/",
+        "PERSISTENCE_PATH": os.path.join(workdir, "state.sqlite3"),
+        "OUTBOUND_GLOBAL_RATE": str(args.outbound_rate),
+        "OUTBOUND_CHAT_INTERVAL": "0",
+        "KYC_SYNC_INTERVAL": str(args.sync_interval),
+    })
+    import main
+    from google.oauth2.credentials import Credentials
+
+    main.creds = Credentials(token="bench")
+    main.creds_loaded.set()
+    main.keep_running.set()
+    main.state_store.open()
+    app = main.build_application()
+    await app.initialize()
+    await app.start()
+    main.outbound.start(app.bot)
+    # Google imports, client build and the first sheet read happen here, not inside the measured handlers
+    started = time.perf_counter()
+    await main.kyc_sync.sync_async()
+    print(f"warm-up (Sheets client build + first sync): {(time.perf_counter() - started) * 1000:.0f} ms")
+    sync_task = asyncio.create_task(main.kyc_sync.run())
+
+    users = list(range(1000, 1000 + args.users))
+    scenarios = {
+        "start": lambda: start_storm(users),
+        "refresh": lambda: refresh_spam(users, args.refresh_taps),
+        "contact": lambda: contact_burst(users),
+    }
+    selected = scenarios if args.scenario == "all" else {args.scenario: scenarios[args.scenario]}
+    try:
+        for name, make_stream in selected.items():
+            stream = make_stream()
+            latencies, handlers, handled, drained = await replay(main, app, stream)
+            report(name, latencies, handlers, handled, drained, len(stream))
+    finally:
+        main.keep_running.clear()
+        sync_task.cancel()
+        await main.outbound.stop()
+        await app.stop()
+        await app.shutdown()
+        main.state_store.close()
+        main.sheets_executor.shutdown(wait=False)
+        await bot_api.stop()
+        await sheets.stop()
+
+    print(f"\nBot API calls: {dict(bot_api.calls)}")
+    print(f"Sheets calls:  {dict(sheets.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", choices=["all", "start", "refresh", "contact"], default="all")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--refresh-taps", type=int, default=5)
+    parser.add_argument("--bot-latency", type=float, default=20, help="ms added to each Bot API call")
+    parser.add_argument("--sheets-latency", type=float, default=150, help="ms added to each Sheets call")
+    parser.add_argument("--rows", type=int, default=5000, help="rows per KYC sheet")
+    parser.add_argument("--outbound-rate", type=float, default=1000, help="global outbound msg/s limit")
+    parser.add_argument("--sync-interval", type=int, default=5, help="seconds between background sheet syncs")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
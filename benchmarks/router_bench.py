@@ -0,0 +1,97 @@
+"""Compare callback dispatch cost: the old chain of regex CallbackQueryHandlers vs CallbackRouter.
+
+Usage: python benchmarks/router_bench.py [--rounds 20000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler
+
+from main import callback_router
+
+# The handler chain run_telegram_bot registered before the router, in the same order
+LEGACY_PATTERNS = [
+    "^rules$",
+    "^form$",
+    "^kyc_check_start$",
+    "^payment_info_start$",
+    "^kyc_check_(new|old)$",
+    "^payment_info_(new|old)$",
+    "^payment_(new|old)$",
+    "^payment_(new_member|old_member)$",
+    "^contact_admin$",
+    "^help$",
+    "^cancel_message$",
+    "^cancel_reply$",
+    "^back$",
+    "^reply_",
+]
+
+SAMPLE_DATA = [
+    "rules", "form", "kyc_check_start", "payment_info_start", "kyc_check_new", "kyc_check_old",
+    "payment_info_new", "payment_new", "payment_old_member", "contact_admin", "help",
+    "cancel_message", "cancel_reply", "back", "reply_5512534898",
+]
+
+
+async def noop(update, context):
+    pass
+
+
+def make_update(update_id, data):
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+            "chat_instance": "bench",
+            "data": data,
+        },
+    }, None)
+
+
+def legacy_dispatch(handlers, update):
+    for handler in handlers:
+        if handler.check_update(update) not in (None, False):
+            return handler
+    return None
+
+
+def router_dispatch(router_handler, update):
+    router_handler.check_update(update)
+    action = callback_router.parse(update.callback_query.data)
+    return callback_router.handlers[action.name]
+
+
+def bench(label, func, updates, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            func(update)
+    elapsed = time.perf_counter() - started
+    per_dispatch = elapsed / (rounds * len(updates)) * 1e9
+    print(f"{label:<16} {per_dispatch:>10.0f} ns/dispatch")
+    return per_dispatch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+
+    handlers = [CallbackQueryHandler(noop, pattern=pattern) for pattern in LEGACY_PATTERNS]
+    updates = [make_update(i, data) for i, data in enumerate(SAMPLE_DATA)]
+
+    legacy = bench("regex chain", lambda u: legacy_dispatch(handlers, u), updates, args.rounds)
+    router_handler = CallbackQueryHandler(callback_router.dispatch)
+    router = bench("callback router", lambda u: router_dispatch(router_handler, u), updates, args.rounds)
+    print(f"speedup: {legacy / router:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Cold-start benchmark: where startup time goes and how soon the service answers.
+
+Measures, each in a fresh interpreter:
+  * importing main (the Google client libraries are no longer on this path)
+  * the work that is now deferred: Google imports, credential parsing, Sheets client build
+  * time from spawning `python main.py` to the first HTTP response and to a healthy /health
+
+Telegram and Sheets are served by the local fakes in benchmarks/fakes.py.
+
+Usage: python benchmarks/startup_bench.py [--runs 3]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import FakeBotApi, FakeSheets
+
+PHASES_SCRIPT = """
+import json, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+import googleapiclient.discovery, google.oauth2.service_account, google_auth_httplib2
+t2 = time.perf_counter()
+main.load_credentials()
+t3 = time.perf_counter()
+main.get_sheets_client()
+t4 = time.perf_counter()
+print(json.dumps({"import main": t1 - t0, "google imports (deferred)": t2 - t1,
+                  "credential load (deferred)": t3 - t2, "sheets client build (deferred)": t4 - t3}))
+"""
+
+
+def service_account_json(token_uri):
+    import rsa
+
+    _, private_key = rsa.newkeys(2048)
+    return json.dumps({
+        "type": "service_account",
+        "project_id": "bench",
+        "private_key_id": "bench",
+        "private_key": private_key.save_pkcs1().decode(),
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "client_id": "1",
+        "token_uri": token_uri,
+    })
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def measure_phases(env):
+    output = subprocess.run([sys.executable, "-c", PHASES_SCRIPT], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_first_response(env):
+    port = free_port()
+    env = dict(env, PORT=str(port))
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + 30
+        first = wait_for(f"http://127.0.0.1:{port}/", deadline)
+        healthy = wait_for(f"http://127.0.0.1:{port}/health", deadline)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+    return {
+        "first HTTP response": first - started if first else float("nan"),
+        "healthy /health": healthy - started if healthy else float("nan"),
+    }
+
+
+async def run(args):
+    bot_api = await FakeBotApi().start()
+    sheets = await FakeSheets(rows=args.rows).start()
+    workdir = tempfile.mkdtemp(prefix="odvut-startup-")
+    env = dict(os.environ, **{
+        "BOT_TOKEN": "123456:BENCH",
+        "BOT_API_URL": bot_api.url,
+        "SHEETS_API_ENDPOINT": sheets.url + "/",
+        "GOOGLE_SERVICE_ACCOUNT_JSON": service_account_json(sheets.url + "/token"),
+        "PERSISTENCE_PATH": os.path.join(workdir, "state.sqlite3"),
+        "KYC_SYNC_INTERVAL": "5",
+    })
+
+    results = {}
+    try:
+        for _ in range(args.runs):
+            # The fakes have to keep serving while the child processes run
+            phases = await asyncio.to_thread(measure_phases, env)
+            phases.update(await asyncio.to_thread(measure_first_response, env))
+            for name, seconds in phases.items():
+                results.setdefault(name, []).append(seconds)
+    finally:
+        await bot_api.stop()
+        await sheets.stop()
+
+    print(f"{'phase':<32} {'median ms':>10} {'max ms':>10}")
+    for name, samples in results.items():
+        print(f"{name:<32} {statistics.median(samples) * 1000:>10.1f} {max(samples) * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=1000, help="rows per KYC sheet for the warm-up sync")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,28 @@
 import os
 import json
+import hashlib
 import secrets
+import hmac
 import threading
 import asyncio
 import time
+import sqlite3
+import itertools
+import bisect
+import functools
+from collections import namedtuple, OrderedDict
 from threading import Event
-from datetime import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from collections import defaultdict
-from flask import Flask
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, jsonify, request
+from werkzeug.exceptions import RequestEntityTooLarge
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     filters,
@@ -31,22 +40,264 @@ def home():
 
 @server.route("/health")
 def health():
-    return "OK", 200
+    checks = {
+        "event_loop": loop_monitor.healthy(),
+        "updates": update_source_healthy(),
+        "kyc_data": kyc_sync.healthy()
+    }
+    return jsonify({"ok": all(checks.values()), **checks}), 200 if all(checks.values()) else 503
+
+@server.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@server.route("/stats")
+def stats():
+    return jsonify({
+        "kyc_sync": kyc_sync.stats(),
+        "user_message_limiter": user_message_limiter.stats(),
+        "forward_limiter": forward_limiter.stats(),
+        "outbound": outbound.stats(),
+        "updates": update_stats.stats(),
+        "kyc_notifications": kyc_watcher.notified,
+        "kyc_writes": kyc_writer.stats(),
+        "message_edits": {"edited": render_cache.edits, "skipped": render_cache.skipped, "tracked": len(render_cache.rendered)},
+        "admin_digest": {"buffered": admin_digest.buffered, "digests_sent": admin_digest.digests_sent}
+    }), 200
+
+# --- Metrics ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()  # Also updated from the sheets worker threads
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()  # Also observed from the sheets worker threads
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                # Per-bucket counts (plus +Inf), running sum, total count
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            # Copy so a scrape sees each series' counts, sum and count from the same moment
+            values = [(label_values, (list(counts), total, count)) for label_values, (counts, total, count) in self.values.items()]
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ("le",), label_values + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class CallbackMetric:
+    # Read from existing stats at scrape time, so hot paths keep their plain counters
+    def __init__(self, name, help_text, kind, read, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.read = read
+        self.labels = labels
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"Metrics error ({metric.name}): {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+handler_latency = metrics.register(Histogram("bot_handler_seconds", "Time spent in each update handler", ("handler",)))
+handler_errors = metrics.register(Counter("bot_handler_errors_total", "Handler calls that raised", ("handler",)))
+sheets_latency = metrics.register(Histogram("sheets_request_seconds", "Google Sheets API call duration", ("operation",)))
+sheets_errors = metrics.register(Counter("sheets_request_errors_total", "Google Sheets API calls that failed", ("operation",)))
+outbound_errors = metrics.register(Counter("outbound_send_errors_total", "Outbound Telegram send errors", ("error",)))
+loop_lag = metrics.register(Histogram("event_loop_lag_seconds", "Delay of a periodic event loop tick", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)))
+
+metrics.register(CallbackMetric("rate_limiter_rejections_total", "Messages rejected by a rate limiter", "counter", lambda: {
+    ("user_message",): user_message_limiter.rejected,
+    ("forward",): forward_limiter.rejected
+}, ("limiter",)))
+metrics.register(CallbackMetric("rate_limiter_tracked_users", "Users with live rate limiter state", "gauge", lambda: {
+    ("user_message",): user_message_limiter.tracked_users(),
+    ("forward",): forward_limiter.tracked_users()
+}, ("limiter",)))
+metrics.register(CallbackMetric("outbound_messages_total", "Outbound Telegram messages by result", "counter", lambda: {
+    ("sent",): outbound.sent,
+    ("retried",): outbound.retried,
+    ("failed",): outbound.failed
+}, ("result",)))
+metrics.register(CallbackMetric("outbound_queue_depth", "Outbound messages waiting to be sent", "gauge", lambda: outbound.stats()["queued"]))
+metrics.register(CallbackMetric("update_queue_depth", "Updates waiting in the application queue", "gauge", lambda: update_stats.stats()["queue_depth"]))
+metrics.register(CallbackMetric("updates_in_flight", "Updates currently being handled", "gauge", lambda: update_stats.in_flight))
+metrics.register(CallbackMetric("updates_waiting", "Updates waiting for a slot or their user's turn", "gauge", lambda: update_stats.waiting))
+metrics.register(CallbackMetric("updates_processed_total", "Updates handled", "counter", lambda: update_stats.processed))
+metrics.register(CallbackMetric("kyc_notifications_total", "KYC status-change messages pushed to users", "counter", lambda: kyc_watcher.notified))
+metrics.register(CallbackMetric("kyc_syncs_total", "Completed KYC sheet syncs", "counter", lambda: kyc_sync.sync_count))
+metrics.register(CallbackMetric("kyc_sync_errors_total", "Failed KYC sheet syncs", "counter", lambda: kyc_sync.error_count))
+metrics.register(CallbackMetric("kyc_sync_duration_seconds", "Duration of the last KYC sheet sync", "gauge", lambda: kyc_sync.last_sync_duration or 0))
+metrics.register(CallbackMetric("message_edits_total", "Callback message edits by result", "counter", lambda: {
+    ("edited",): render_cache.edits,
+    ("skipped",): render_cache.skipped
+}, ("result",)))
+metrics.register(CallbackMetric("kyc_writes_pending", "Admin KYC edits waiting to be written to the sheet", "gauge", lambda: len(kyc_writer.pending)))
+metrics.register(CallbackMetric("kyc_write_batches_total", "batchUpdate calls made for admin KYC edits", "counter", lambda: kyc_writer.batches))
+metrics.register(CallbackMetric("kyc_sync_age_seconds", "Seconds since the last successful KYC sheet sync", "gauge", lambda: time.time() - kyc_sync.last_sync_at if kyc_sync.last_sync_at else -1))
+
+def instrumented(handler, name=None):
+    name = name or handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, name)
+    return wrapper
+
+class LoopMonitor:
+    def __init__(self, interval=1.0, stall_seconds=10):
+        self.interval = interval
+        self.stall_seconds = stall_seconds
+        self.last_beat = None
+
+    async def run(self):
+        while keep_running.is_set():
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_beat = time.monotonic()
+            loop_lag.observe(max(0.0, self.last_beat - expected))
+
+    def healthy(self):
+        return self.last_beat is not None and time.monotonic() - self.last_beat < self.stall_seconds
+
+loop_monitor = LoopMonitor()
+bot_app = None
+bot_loop = None
+
+def update_source_healthy():
+    if bot_app is None or not bot_app.running:
+        return False
+    return BOT_MODE == "webhook" or bot_app.updater.running
 
 # Initialize message limiter
 class MessageLimiter:
-    def __init__(self):
-        self.user_messages = defaultdict(list)
+    def __init__(self, max_messages=3, period_seconds=60):
+        self.max_messages = max_messages
+        self.period_seconds = period_seconds
+        self.refill_rate = max_messages / period_seconds
+        # user_id -> (tokens, updated) for users seen this period and the one before. Anything older
+        # has been idle a whole period, so it is full again and dropping it is lossless.
+        # Tuples of floats are not tracked by the garbage collector, so a million users stay cheap
+        self.buckets = {}
+        self.previous = {}
+        self.retired = []  # Generations waiting to be freed a few entries per call
+        self.next_rotation = time.monotonic() + period_seconds
+        self.rejected = 0
 
-    def check_limit(self, user_id, max_messages=3, period_seconds=60):
-        now = datetime.now()
-        self.user_messages[user_id] = [t for t in self.user_messages[user_id] if (now - t).seconds < period_seconds]
-        if len(self.user_messages[user_id]) < max_messages:
-            self.user_messages[user_id].append(now)
+    def check_limit(self, user_id):
+        # Token bucket: bursts of max_messages, refilled evenly over period_seconds
+        now = time.monotonic()
+        if now >= self.next_rotation:
+            self.rotate(now)
+        if self.retired:
+            self.sweep()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.previous.pop(user_id, None)
+        if bucket is None:
+            tokens = self.max_messages
+        else:
+            tokens = min(self.max_messages, bucket[0] + (now - bucket[1]) * self.refill_rate)
+        allowed = tokens >= 1
+        self.buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        if allowed:
             return True
+        self.rejected += 1
         return False
 
-message_limiter = MessageLimiter()
+    def rotate(self, now):
+        # O(1): freeing a million entries at once would stall the event loop, so that is spread out
+        if self.previous:
+            self.retired.append(self.previous)
+        self.previous, self.buckets = self.buckets, {}
+        self.next_rotation = now + self.period_seconds
+
+    def sweep(self, limit=256):
+        retired = self.retired[-1]
+        for _ in range(min(limit, len(retired))):
+            retired.popitem()
+        if not retired:
+            self.retired.pop()
+
+    def tracked_users(self):
+        return len(self.buckets) + len(self.previous)
+
+    def stats(self):
+        return {"tracked_users": self.tracked_users(), "rejected": self.rejected}
 
 # --- Configuration ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -55,17 +306,77 @@ ADMIN_USERNAME_2 = "@mohammadtajid03"
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "5512534898"))
 ADMIN_CHAT_ID_2 = int(os.getenv("ADMIN_CHAT_ID_2", "5319025828")) # For old members
 
+BOT_API_URL = os.getenv("BOT_API_URL")  # Optional self-hosted Bot API server, e.g. http://localhost:8081
+
+# Update ingestion: "polling" (default) or "webhook" on the same port as the HTTP routes
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+PORT = int(os.environ.get("PORT", 5000))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", os.getenv("RENDER_EXTERNAL_URL", ""))
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+WEBHOOK_ENQUEUE_TIMEOUT = 5  # Seconds to wait for queue space before asking Telegram to retry
+WEBHOOK_MAX_BODY = 1024 * 1024
+
 # Google Sheets Configuration
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "here")
 SHEET_RANGES = {
     "new_member": ["New_User!A:D", "Verified_User!A:D"],
     "old_member": ["Old_User!A:D"]
 }
+KYC_SYNC_INTERVAL = int(os.getenv("KYC_SYNC_INTERVAL", "60"))  # Seconds between background sheet syncs
+KYC_WRITE_INTERVAL = int(os.getenv("KYC_WRITE_INTERVAL", "5"))  # Seconds admin KYC edits are coalesced before one batchUpdate
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "4"))
+SHEETS_HTTP_TIMEOUT = int(os.getenv("SHEETS_HTTP_TIMEOUT", "30"))
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT")  # Override for local Sheets stand-ins
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)  # Refresh access tokens this long before they expire
 FORM_URL = os.getenv("FORM_URL", "https://forms.gle/YOUR_GOOGLE_FORM_LINK")
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
+# State persistence (SQLite, written behind the handlers)
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "bot_state.sqlite3")
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "2"))
+PERSISTENCE_HOT_SECONDS = int(os.getenv("PERSISTENCE_HOT_SECONDS", "86400"))  # user_data newer than this is loaded at startup
+
+# Update processing: parallel across users, strictly ordered per user/chat
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+
+# Outbound message scheduling (Telegram allows ~30 msg/s overall and ~1 msg/s per chat)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_INTERVAL = float(os.getenv("OUTBOUND_CHAT_INTERVAL", "1"))
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))
+OUTBOUND_MAX_ATTEMPTS = 5
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+PRIORITY_NOTIFY = 2
+PRIORITY_LOG = 3
+
+# Admin digest: buffer inbound user messages and send admins one summary per window (0 disables)
+ADMIN_DIGEST_WINDOW = int(os.getenv("ADMIN_DIGEST_WINDOW", "0"))
+URGENT_KEYWORDS = [k.strip().lower() for k in os.getenv("URGENT_KEYWORDS", "urgent,scam,payment").split(",") if k.strip()]
+DIGEST_MAX_SENDERS = 20  # Reply buttons per digest message
+DIGEST_MAX_CHARS = 3500  # Stay well under Telegram's 4096 character limit
+
+RENDER_CACHE_SIZE = 10000  # Messages whose last rendered content is remembered to skip no-op edits
+
+# Payment codes: kept this long, exported to PAYMENT_SHEET_RANGE in batches
+PAYMENT_CODE_TTL = int(os.getenv("PAYMENT_CODE_TTL", str(7 * 24 * 3600)))
+PAYMENT_EXPORT_INTERVAL = int(os.getenv("PAYMENT_EXPORT_INTERVAL", "60"))
+PAYMENT_SHEET_RANGE = os.getenv("PAYMENT_SHEET_RANGE", "Payments!A:E")
+
+# Message rate limits (messages per period, in seconds)
+USER_MESSAGE_LIMIT = int(os.getenv("USER_MESSAGE_LIMIT", "3"))
+USER_MESSAGE_PERIOD = int(os.getenv("USER_MESSAGE_PERIOD", "60"))
+FORWARD_LIMIT = int(os.getenv("FORWARD_LIMIT", "3"))
+FORWARD_PERIOD = int(os.getenv("FORWARD_PERIOD", "60"))
+
+user_message_limiter = MessageLimiter(USER_MESSAGE_LIMIT, USER_MESSAGE_PERIOD)
+forward_limiter = MessageLimiter(FORWARD_LIMIT, FORWARD_PERIOD)
+
 # --- Google Sheets Credentials ---
 def get_google_credentials():
+    from google.oauth2 import service_account
+
     service_account_info = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
     if service_account_info:
         try:
@@ -80,41 +391,516 @@ def get_google_credentials():
         print("Error: No Google service account credentials found")
         return None
 
-creds = get_google_credentials()
+# Loaded on first use (or by the startup warm-up) so the Google libraries stay off the import path
+creds = None
+creds_loaded = Event()
+creds_lock = threading.Lock()
+
+def load_credentials():
+    global creds
+    with creds_lock:
+        if not creds_loaded.is_set():
+            creds = get_google_credentials()
+            creds_loaded.set()
+    return creds
 
 # --- User Data Storage ---
-user_states = {}
-user_messages = {}
+class StateStore:
+    def __init__(self, path, flush_interval):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.conn = None
+        self.write_conn = None
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wake = Event()
+        self.writer = None
+
+    def open(self):
+        if self.conn:
+            return
+        self.write_conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.write_conn.execute("PRAGMA journal_mode=WAL")
+        self.write_conn.execute("PRAGMA synchronous=NORMAL")
+        self.write_conn.execute("CREATE TABLE IF NOT EXISTS state (namespace TEXT, key TEXT, value TEXT, updated REAL, PRIMARY KEY (namespace, key))")
+        self.write_conn.execute("CREATE INDEX IF NOT EXISTS state_updated ON state (namespace, updated)")
+        self.write_conn.commit()
+        # Separate reader connection; WAL lets it read while the writer commits
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.writer = threading.Thread(target=self.write_loop, name="state-writer", daemon=True)
+        self.writer.start()
+
+    def put(self, namespace, key, value):
+        # Writes are only queued; the writer thread commits them in batches
+        with self.pending_lock:
+            self.pending[(namespace, str(key))] = (value, time.time())
+
+    def delete(self, namespace, key):
+        self.put(namespace, key, None)
+
+    def get(self, namespace, key):
+        with self.pending_lock:
+            pending = self.pending.get((namespace, str(key)))
+        if pending:
+            return pending[0]
+        if not self.conn:
+            return None
+        row = self.conn.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, str(key))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load(self, namespace, since=None):
+        if not self.conn:
+            return {}
+        if since is None:
+            rows = self.conn.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,))
+        else:
+            rows = self.conn.execute("SELECT key, value FROM state WHERE namespace = ? AND updated >= ?", (namespace, since))
+        return {key: json.loads(value) for key, value in rows}
+
+    def write_loop(self):
+        while self.writer:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.write_lock:
+            with self.pending_lock:
+                batch, self.pending = self.pending, {}
+            if not batch or not self.write_conn:
+                return
+            upserts = [(ns, key, json.dumps(value), updated) for (ns, key), (value, updated) in batch.items() if value is not None]
+            deletes = [(ns, key) for (ns, key), (value, _) in batch.items() if value is None]
+            try:
+                with self.write_conn:
+                    self.write_conn.executemany("INSERT OR REPLACE INTO state (namespace, key, value, updated) VALUES (?, ?, ?, ?)", upserts)
+                    self.write_conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+            except sqlite3.Error as e:
+                print(f"State store write error: {e}")
+
+    def close(self):
+        if not self.writer:
+            return
+        writer, self.writer = self.writer, None
+        self.wake.set()
+        writer.join(timeout=10)
+        self.flush()
+        self.conn.close()
+        self.write_conn.close()
+        self.conn = self.write_conn = None
+
+class PersistentDict(dict):
+    def __init__(self, store, namespace):
+        super().__init__()
+        self.store = store
+        self.namespace = namespace
+
+    def load(self):
+        super().update({int(key): value for key, value in self.store.load(self.namespace).items()})
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.store.put(self.namespace, key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.store.delete(self.namespace, key)
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        self.store.delete(self.namespace, key)
+        return value
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, store):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=store.flush_interval
+        )
+        self.store = store
+        self.loaded_users = set()
+
+    async def get_user_data(self):
+        # Only recently active users are loaded up front; the rest are read on first update
+        hot = await asyncio.to_thread(self.store.load, "user_data", time.time() - PERSISTENCE_HOT_SECONDS)
+        user_data = {int(user_id): data for user_id, data in hot.items()}
+        self.loaded_users.update(user_data)
+        return user_data
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self.loaded_users:
+            return
+        self.loaded_users.add(user_id)
+        stored = await asyncio.to_thread(self.store.get, "user_data", user_id)
+        if stored:
+            user_data.update(stored)
+
+    async def update_user_data(self, user_id, data):
+        self.loaded_users.add(user_id)
+        if data:
+            self.store.put("user_data", user_id, dict(data))
+        else:
+            self.store.delete("user_data", user_id)
+
+    async def drop_user_data(self, user_id):
+        self.store.delete("user_data", user_id)
+
+    async def flush(self):
+        await asyncio.to_thread(self.store.flush)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+state_store = StateStore(PERSISTENCE_PATH, PERSISTENCE_FLUSH_INTERVAL)
+user_states = PersistentDict(state_store, "user_states")
+user_messages = PersistentDict(state_store, "user_messages")  # Write-only log of the last message per user
+
+# --- Outbound Scheduler ---
+class OutboundMessage:
+    __slots__ = ("priority", "seq", "chat_id", "text", "kwargs", "future", "attempts")
+
+    def __init__(self, priority, seq, chat_id, text, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+class OutboundScheduler:
+    def __init__(self, global_rate, chat_interval, workers):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = chat_interval
+        self.worker_count = workers
+        self.bot = None
+        self.queue = None
+        self.workers = []
+        self.seq = itertools.count()
+        self.next_global_slot = 0.0
+        self.chat_ready = {}
+        self.delayed = {}  # seq -> timer handle for messages waiting on a chat interval or backoff
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self, bot):
+        self.bot = bot
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+
+    async def drain(self):
+        # Delayed messages are outside the queue until their timer fires
+        while True:
+            await self.queue.join()
+            if not self.delayed:
+                return
+            await asyncio.sleep(0.05)
+
+    async def stop(self, timeout=5):
+        if not self.workers:
+            return
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Dropping {self.queue.qsize() + len(self.delayed)} queued outbound messages")
+            for handle in self.delayed.values():
+                handle.cancel()
+            self.delayed = {}
+        for task in self.workers:
+            task.cancel()
+        self.workers = []
+
+    def send(self, chat_id, text, priority=PRIORITY_USER, **kwargs):
+        # Returns at once; the message goes out when the rate limits allow
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self.log_failure)
+        self.enqueue(OutboundMessage(priority, next(self.seq), chat_id, text, kwargs, future))
+        return future
+
+    def fan_out(self, chat_ids, text, priority=PRIORITY_ADMIN, **kwargs):
+        return [self.send(chat_id, text, priority, **kwargs) for chat_id in chat_ids]
+
+    def enqueue(self, message):
+        self.queue.put_nowait((message.priority, message.seq, message))
+
+    def requeue_later(self, message, delay):
+        self.delayed[message.seq] = asyncio.get_running_loop().call_later(delay, self.release, message)
+
+    def release(self, message):
+        del self.delayed[message.seq]
+        self.enqueue(message)
+
+    def log_failure(self, future):
+        if not future.cancelled() and future.exception():
+            print(f"Outbound send error: {future.exception()}")
+
+    async def wait_for_global_slot(self):
+        now = time.monotonic()
+        slot = max(now, self.next_global_slot)
+        self.next_global_slot = slot + self.global_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def worker(self):
+        while True:
+            _, _, message = await self.queue.get()
+            try:
+                await self.deliver(message)
+            finally:
+                self.queue.task_done()
+
+    async def deliver(self, message):
+        now = time.monotonic()
+        ready_at = self.chat_ready.get(message.chat_id, 0)
+        if ready_at > now:
+            self.requeue_later(message, ready_at - now)
+            return
+        self.chat_ready[message.chat_id] = now + self.chat_interval
+        if len(self.chat_ready) > 10000:
+            self.chat_ready = {chat_id: t for chat_id, t in self.chat_ready.items() if t > now}
+        await self.wait_for_global_slot()
+        message.attempts += 1
+        try:
+            result = await self.bot.send_message(chat_id=message.chat_id, text=message.text, **message.kwargs)
+        except RetryAfter as e:
+            outbound_errors.inc("RetryAfter")
+            # Flood control: hold back every chat, not just this one
+            self.next_global_slot = max(self.next_global_slot, time.monotonic() + e.retry_after)
+            self.retried += 1
+            self.requeue_later(message, e.retry_after)
+        except (BadRequest, Forbidden) as e:
+            # Permanent: bad markup, unknown chat, bot blocked. Retrying cannot help
+            outbound_errors.inc(type(e).__name__)
+            self.failed += 1
+            message.future.set_exception(e)
+        except (TimedOut, NetworkError) as e:
+            outbound_errors.inc(type(e).__name__)
+            if message.attempts >= OUTBOUND_MAX_ATTEMPTS:
+                self.failed += 1
+                message.future.set_exception(e)
+            else:
+                self.retried += 1
+                self.requeue_later(message, 2 ** message.attempts)
+        except Exception as e:
+            outbound_errors.inc(type(e).__name__)
+            self.failed += 1
+            message.future.set_exception(e)
+        else:
+            self.sent += 1
+            message.future.set_result(result)
+
+    def stats(self):
+        return {
+            "queued": (self.queue.qsize() if self.queue else 0) + len(self.delayed),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+
+outbound = OutboundScheduler(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_INTERVAL, OUTBOUND_WORKERS)
+
+# --- Admin Digest ---
+def is_urgent(text):
+    lowered = text.lower()
+    return any(keyword in lowered for keyword in URGENT_KEYWORDS)
+
+class AdminDigest:
+    def __init__(self, window):
+        self.window = window
+        self.buffers = {}
+        self.flush_handle = None
+        self.buffered = 0
+        self.digests_sent = 0
+
+    def submit(self, admin_chat_ids, user_id, username, text, immediate_text, urgent=False):
+        # Returns the send futures when the message goes out immediately, [] when it is buffered
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("📩 Reply", callback_data=f"reply_{user_id}")]])
+        if self.window <= 0 or urgent:
+            return outbound.fan_out(admin_chat_ids, immediate_text, reply_markup=reply_markup)
+        for chat_id in admin_chat_ids:
+            self.buffers.setdefault(chat_id, {}).setdefault(user_id, {"username": username, "texts": []})["texts"].append(text)
+        self.buffered += 1
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return []
+
+    def flush(self):
+        self.flush_handle = None
+        buffers, self.buffers = self.buffers, {}
+        for chat_id, senders in buffers.items():
+            for text, reply_markup in self.render(senders):
+                outbound.send(chat_id, text, priority=PRIORITY_ADMIN, reply_markup=reply_markup)
+                self.digests_sent += 1
+
+    def render(self, senders):
+        # One message per batch of senders, each with its own reply button
+        chunks, sections, buttons, length = [], [], [], 0
+        for user_id, sender in senders.items():
+            section = f"👤 @{sender['username']} (ID: {user_id}):\n" + "\n".join(f"• {text}" for text in sender["texts"])
+            if sections and (len(buttons) >= DIGEST_MAX_SENDERS or length + len(section) > DIGEST_MAX_CHARS):
+                chunks.append((sections, buttons))
+                sections, buttons, length = [], [], 0
+            sections.append(section[:DIGEST_MAX_CHARS])
+            buttons.append([InlineKeyboardButton(f"📩 Reply @{sender['username']}", callback_data=f"reply_{user_id}")])
+            length += len(section)
+        if sections:
+            chunks.append((sections, buttons))
+        return [
+            (f"📬 Message digest ({len(chunk_sections)} users)\n\n" + "\n\n".join(chunk_sections), InlineKeyboardMarkup(chunk_buttons))
+            for chunk_sections, chunk_buttons in chunks
+        ]
+
+admin_digest = AdminDigest(ADMIN_DIGEST_WINDOW)
+
+# --- Payment Ledger ---
+class PaymentLedger:
+    def __init__(self, store, ttl_seconds, export_interval):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.export_interval = export_interval
+        self.by_code = {}
+        self.by_user = {}
+
+    def load(self):
+        # Only codes that have not expired yet
+        for code, record in self.store.load("payments", since=time.time() - self.ttl_seconds).items():
+            self.index(record)
+
+    def index(self, record):
+        self.by_code[record["code"]] = record
+        latest = self.by_code.get(self.by_user.get(record["user_id"]))
+        if latest is None or latest["created_at"] <= record["created_at"]:
+            self.by_user[record["user_id"]] = record["code"]
+
+    def new_code(self, user, member_type):
+        code = None
+        while code is None or code in self.by_code:
+            code = ''.join(secrets.choice('ABCDEFGHJKLMNPQRSTUVWXYZ23456789') for _ in range(8))
+        record = {
+            "code": code,
+            "user_id": user.id,
+            "username": user.username or "",
+            "member_type": member_type,
+            "created_at": time.time(),
+            "exported": False
+        }
+        self.index(record)
+        self.store.put("payments", code, record)
+        return code
+
+    def lookup(self, code):
+        record = self.by_code.get(code.strip().upper())
+        if record and time.time() - record["created_at"] < self.ttl_seconds:
+            return record
+        return None
+
+    def lookup_user(self, user_id):
+        code = self.by_user.get(user_id)
+        return self.lookup(code) if code else None
+
+    def sweep(self):
+        expired_before = time.time() - self.ttl_seconds
+        for code, record in list(self.by_code.items()):
+            if record["created_at"] < expired_before:
+                del self.by_code[code]
+                if self.by_user.get(record["user_id"]) == code:
+                    del self.by_user[record["user_id"]]
+                self.store.delete("payments", code)
+
+    def export_rows(self, records):
+        client = get_sheets_client()
+        rows = [
+            [r["code"], r["user_id"], f"@{r['username']}" if r["username"] else "", r["member_type"],
+             datetime.fromtimestamp(r["created_at"]).strftime("%Y-%m-%d %H:%M:%S")]
+            for r in records
+        ]
+        client.execute(client.values().append(
+            spreadsheetId=SPREADSHEET_ID, range=PAYMENT_SHEET_RANGE, valueInputOption="RAW",
+            insertDataOption="INSERT_ROWS", body={"values": rows}
+        ))
+
+    async def export_pending(self):
+        # One append call for every code created since the last export
+        pending = sorted((r for r in self.by_code.values() if not r["exported"]), key=lambda r: r["created_at"])
+        if not pending or not creds:
+            return
+        await run_sheets_io(self.export_rows, pending)
+        for record in pending:
+            record["exported"] = True
+            self.store.put("payments", record["code"], record)
+
+    async def run(self):
+        while keep_running.is_set():
+            await asyncio.sleep(self.export_interval)
+            self.sweep()
+            try:
+                await self.export_pending()
+            except Exception as e:
+                print(f"Payment export error: {e}")
+
+payment_ledger = PaymentLedger(state_store, PAYMENT_CODE_TTL, PAYMENT_EXPORT_INTERVAL)
 
 # --- Keyboards / Menus ---
-def get_main_menu():
-    keyboard = [
-        [InlineKeyboardButton("📌 Rules", callback_data="rules")],
-        [InlineKeyboardButton("📝 Admission Form", callback_data="form")],
-        [InlineKeyboardButton("🆔 KYC Check", callback_data="kyc_check_start")],
-        [InlineKeyboardButton("💳 Payment Info", callback_data="payment_info_start")],
-        [InlineKeyboardButton("📞 Contact Us", callback_data="contact_admin")],
-        [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+# Static texts and markups are built once; PTB's Telegram objects are immutable, so sharing them is safe
+MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📌 Rules", callback_data="rules")],
+    [InlineKeyboardButton("📝 Admission Form", callback_data="form")],
+    [InlineKeyboardButton("🆔 KYC Check", callback_data="kyc_check_start")],
+    [InlineKeyboardButton("💳 Payment Info", callback_data="payment_info_start")],
+    [InlineKeyboardButton("📞 Contact Us", callback_data="contact_admin")],
+    [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
+])
 
-def get_member_type_menu(action):
-    keyboard = [
+MEMBER_TYPE_MENUS = {
+    action: InlineKeyboardMarkup([
         [InlineKeyboardButton("New Member", callback_data=f"{action}_new")],
         [InlineKeyboardButton("Old Member", callback_data=f"{action}_old")],
         [InlineKeyboardButton("🔙 Back to Menu", callback_data="back")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    ])
+    for action in ("kyc_check", "payment_info")
+}
 
-# --- Core Bot Functions ---
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    welcome_msg = f"Hello {update.effective_user.first_name}!\n\nWelcome to *Odvut Info Bot*. Please choose an option below:"
-    await update.message.reply_text(welcome_msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_main_menu())
+BACK_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="back")]])
+BACK_TO_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Menu", callback_data="back")]])
+CANCEL_MESSAGE_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_message")]])
+CANCEL_REPLY_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_reply")]])
 
-async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    rules_text = """
+WELCOME_BACK_TEXT = "👋 Welcome back! Select an option:"
+MEMBER_TYPE_TEXT = "Please select your member type:"
+
+RULES_TEXT = """
 📜 *VERIFICATION REQUIREMENTS*
 
 ✅ *MUST HAVE*
@@ -133,158 +919,633 @@ async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
 - Fake profiles will be banned permanently
 - All info must match your government ID
 """
-    await query.edit_message_text(rules_text, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("📝 Admission Form", callback_data="form")],
-        [InlineKeyboardButton("🔙 Back to Menu", callback_data="back")]
-    ]))
+RULES_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Admission Form", callback_data="form")],
+    [InlineKeyboardButton("🔙 Back to Menu", callback_data="back")]
+])
+
+FORM_TEXT = f"📝 *Admission Form*\n\nPlease fill out the form carefully with accurate information.\nAll fields are required for verification.\n\n[Click here to access the form]({FORM_URL})"
+FORM_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ I\\'ve Submitted", callback_data="back")],
+    [InlineKeyboardButton("🔙 Back", callback_data="back")]
+])
+
+HELP_TEXT = "❓ *Help Center*\n\nFor any assistance, please contact our admin team.\n\n" + f"Admin: {ADMIN_USERNAME}\n" + "We\\'re available to help you."
+HELP_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📞 Contact Admin", callback_data="contact_admin")],
+    [InlineKeyboardButton("🔙 Back", callback_data="back")]
+])
+
+def admin_username_for(member_type):
+    return ADMIN_USERNAME if member_type == "new_member" else ADMIN_USERNAME_2
+
+PAYMENT_INFO_TEXTS = {
+    member_type: (
+        "💳 *Payment Instructions*\n\n"
+        "1. Complete your KYC verification first\n"
+        "2. Payment methods available:\n"
+        "   - Cryptocurrency (USDT)\n"
+        "   - Binance\n"
+        "   - Mexc\n"
+        "3. Contact admin for payment details\n\n"
+        f"Admin: {admin_username_for(member_type)}"
+    )
+    for member_type in SHEET_RANGES
+}
+
+PAYMENT_CODE_MENUS = {
+    member_type: InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 Back", callback_data=f"kyc_check_{member_type.split('_')[0]}")],
+        [InlineKeyboardButton("📞 Contact Admin", url=f"https://t.me/{admin_username_for(member_type)[1:]}")]
+    ])
+    for member_type in SHEET_RANGES
+}
+
+def build_kyc_status_menus(member_type):
+    # Keyed by the entry's "verified" value: None (under review), False, True
+    refresh_data = f"kyc_check_{member_type.split('_')[0]}"
+    return {
+        None: InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Refresh", callback_data=refresh_data)],
+            [InlineKeyboardButton("🔙 Back", callback_data="back")]
+        ]),
+        False: InlineKeyboardMarkup([
+            [InlineKeyboardButton("📝 Submit Verification", url=FORM_URL)],
+            [InlineKeyboardButton("🔄 Refresh Status", callback_data=refresh_data)],
+            [InlineKeyboardButton("🔙 Back", callback_data="back")]
+        ]),
+        True: InlineKeyboardMarkup([
+            [InlineKeyboardButton("💳 Proceed to Payment", callback_data=f"payment_{member_type}")],
+            [InlineKeyboardButton("🔙 Back", callback_data="back")]
+        ])
+    }
+
+KYC_STATUS_MENUS = {member_type: build_kyc_status_menus(member_type) for member_type in SHEET_RANGES}
+
+def get_main_menu():
+    return MAIN_MENU
+
+def get_member_type_menu(action):
+    return MEMBER_TYPE_MENUS[action]
+
+# --- Message Edits ---
+class RenderCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.rendered = OrderedDict()
+        self.edits = 0
+        self.skipped = 0
+
+    @staticmethod
+    def message_key(query):
+        if query.message:
+            return (query.message.chat_id, query.message.message_id)
+        return query.inline_message_id
+
+    @staticmethod
+    def digest(text, parse_mode, reply_markup):
+        content = [text, parse_mode, reply_markup.to_dict() if reply_markup else None]
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).digest()
+
+    def is_current(self, query, text, parse_mode=None, reply_markup=None):
+        return self.rendered.get(self.message_key(query)) == self.digest(text, parse_mode, reply_markup)
+
+    def remember(self, key, digest):
+        self.rendered[key] = digest
+        self.rendered.move_to_end(key)
+        if len(self.rendered) > self.max_entries:
+            self.rendered.popitem(last=False)
+
+    async def edit(self, query, text, parse_mode=None, reply_markup=None):
+        # Skips the API call when the message already shows exactly this content
+        key = self.message_key(query)
+        digest = self.digest(text, parse_mode, reply_markup)
+        if self.rendered.get(key) == digest:
+            self.skipped += 1
+            return False
+        try:
+            await query.edit_message_text(text=text, parse_mode=parse_mode, reply_markup=reply_markup)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+            self.skipped += 1
+        else:
+            self.edits += 1
+        self.remember(key, digest)
+        return True
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+# --- Core Bot Functions ---
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    welcome_msg = f"Hello {update.effective_user.first_name}!\n\nWelcome to *Odvut Info Bot*. Please choose an option below:"
+    outbound.send(update.message.chat_id, welcome_msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_main_menu())
+
+async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await render_cache.edit(query, RULES_TEXT, parse_mode=ParseMode.MARKDOWN, reply_markup=RULES_MENU)
 
 async def show_form(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    form_text = f"📝 *Admission Form*\n\nPlease fill out the form carefully with accurate information.\nAll fields are required for verification.\n\n[Click here to access the form]({FORM_URL})"
-    await query.edit_message_text(form_text, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ I\\'ve Submitted", callback_data="back")],
-        [InlineKeyboardButton("🔙 Back", callback_data="back")]
-    ]))
+    await render_cache.edit(query, FORM_TEXT, parse_mode=ParseMode.MARKDOWN, reply_markup=FORM_MENU)
 
 async def kyc_check_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Please select your member type:", reply_markup=get_member_type_menu("kyc_check"))
+    await render_cache.edit(query, MEMBER_TYPE_TEXT, reply_markup=get_member_type_menu("kyc_check"))
 
 async def payment_info_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Please select your member type:", reply_markup=get_member_type_menu("payment_info"))
+    await render_cache.edit(query, MEMBER_TYPE_TEXT, reply_markup=get_member_type_menu("payment_info"))
+
+# --- Sheets I/O ---
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+
+async def run_sheets_io(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(sheets_executor, func, *args)
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, func, *args):
+        # Callers asking for the same key share one in-flight sheet read
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(run_sheets_io(func, *args))
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+        return await asyncio.shield(future)
+
+sheets_flight = SingleFlight()
+
+class SheetsClient:
+    def __init__(self, credentials):
+        from googleapiclient.discovery import build
+
+        self.credentials = credentials
+        # Bundled discovery document, so building the service never hits the network
+        client_options = {"api_endpoint": SHEETS_API_ENDPOINT} if SHEETS_API_ENDPOINT else None
+        self.service = build("sheets", "v4", credentials=credentials, static_discovery=True, cache_discovery=False, client_options=client_options)
+        self.local = threading.local()
+        self.token_lock = threading.Lock()
+
+    def http(self):
+        # httplib2 connections are not thread-safe, so each worker keeps its own keep-alive transport
+        http = getattr(self.local, "http", None)
+        if http is None:
+            import httplib2
+            import google_auth_httplib2
+
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT))
+            self.local.http = http
+        return http
+
+    def token_expiring(self):
+        if not self.credentials.token:
+            return True
+        expiry = self.credentials.expiry
+        return expiry is not None and expiry - datetime.now(timezone.utc).replace(tzinfo=None) < TOKEN_REFRESH_MARGIN
+
+    def ensure_token(self):
+        if not self.token_expiring():
+            return
+        with self.token_lock:
+            if self.token_expiring():
+                import google_auth_httplib2
+
+                self.credentials.refresh(google_auth_httplib2.Request(self.http().http))
+
+    def execute(self, request):
+        operation = request.methodId.rsplit(".", 1)[-1]
+        started = time.perf_counter()
+        try:
+            self.ensure_token()
+            return request.execute(http=self.http())
+        except Exception:
+            sheets_errors.inc(operation)
+            raise
+        finally:
+            sheets_latency.observe(time.perf_counter() - started, operation)
+
+    def values(self):
+        return self.service.spreadsheets().values()
+
+sheets_client = None
+sheets_client_lock = threading.Lock()
+
+def get_sheets_client():
+    global sheets_client
+    if sheets_client is None:
+        with sheets_client_lock:
+            if sheets_client is None:
+                sheets_client = SheetsClient(creds)
+    return sheets_client
+
+# --- KYC Index ---
+def normalize_username(username):
+    return username.lower().lstrip("@")
+
+def parse_kyc_row(row):
+    status = row[1].strip().upper() if len(row) > 1 and row[1].strip() else ""
+    reason = row[2] if len(row) > 2 and row[2].strip() else "No reason provided"
+    if not status:
+        return {"verified": None, "reason": "Under review"}
+    return {"verified": status == "VERIFIED", "reason": reason}
+
+class KycIndex:
+    def __init__(self):
+        self.entries = {}
+        self.locations = {}
+        self.lock = threading.Lock()
+
+    def build(self, range_values, overrides=dict):
+        # First match wins, same as scanning each member type's ranges top to bottom
+        entries = {}
+        locations = {}
+        for member_type, sheet_ranges in SHEET_RANGES.items():
+            member_entries = {}
+            member_locations = {}
+            for sheet_range in sheet_ranges:
+                for row_number, row in enumerate(range_values.get(sheet_range, []), start=1):
+                    if len(row) > 0:
+                        username = normalize_username(row[0])
+                        if username not in member_entries:
+                            member_entries[username] = parse_kyc_row(row)
+                            member_locations[username] = (sheet_range, row_number)
+            entries[member_type] = member_entries
+            locations[member_type] = member_locations
+        with self.lock:
+            # Admin edits the sheet does not show yet, read under the lock so none made during the build is lost
+            for (member_type, username), entry in overrides().items():
+                if username in entries.get(member_type, {}):
+                    entries[member_type][username] = dict(entry)
+            previous, self.entries, self.locations = self.entries, entries, locations
+        # On the first load everything counts as changed; the watcher compares it with what subscribers were last shown
+        if not previous:
+            return [
+                (member_type, username, entry)
+                for member_type, member_entries in entries.items()
+                for username, entry in member_entries.items()
+            ]
+        return [
+            (member_type, username, entry)
+            for member_type, member_entries in entries.items()
+            for username, entry in member_entries.items()
+            if previous.get(member_type, {}).get(username, {}).get("verified", False) != entry["verified"]
+        ]
+
+    def is_loaded(self, member_type):
+        return member_type in self.entries
+
+    def lookup(self, username, member_type):
+        entry = self.entries[member_type].get(normalize_username(username))
+        if entry is None:
+            return {"verified": False, "reason": "Not found in database"}
+        return dict(entry)
+
+    def locate(self, username, member_type):
+        # (sheet range, row number) of the row lookups are answered from
+        return self.locations.get(member_type, {}).get(username)
+
+    def apply(self, username, member_type, entry):
+        with self.lock:
+            member_entries = self.entries.get(member_type, {})
+            if username not in member_entries:
+                return None
+            previous = member_entries[username]
+            member_entries[username] = dict(entry)
+        return previous
+
+kyc_index = KycIndex()
+
+# --- Sheet Synchronizer ---
+class SheetSynchronizer:
+    def __init__(self, index, interval_seconds):
+        self.index = index
+        self.interval_seconds = interval_seconds
+        self.ranges = list(dict.fromkeys(r for ranges in SHEET_RANGES.values() for r in ranges))
+        self.content_hash = None
+        self.last_sync_at = None
+        self.last_sync_duration = None
+        self.last_changed_at = None
+        self.sync_count = 0
+        self.error_count = 0
+        self.unannounced = []
+        self.unannounced_lock = threading.Lock()
+
+    def fetch(self):
+        client = get_sheets_client()
+        response = client.execute(client.values().batchGet(spreadsheetId=SPREADSHEET_ID, ranges=self.ranges))
+        # valueRanges come back in request order
+        return {r: vr.get("values", []) for r, vr in zip(self.ranges, response.get("valueRanges", []))}
+
+    def sync(self):
+        started = time.monotonic()
+        range_values = self.fetch()
+        content_hash = hashlib.sha256(json.dumps(range_values, sort_keys=True).encode()).hexdigest()
+        changes = []
+        if content_hash != self.content_hash:
+            changes = self.index.build(range_values, lambda: kyc_writer.overrides(started))
+            with self.unannounced_lock:
+                self.unannounced.extend(changes)
+            self.content_hash = content_hash
+            self.last_changed_at = time.time()
+        self.last_sync_at = time.time()
+        self.last_sync_duration = time.monotonic() - started
+        self.sync_count += 1
+        return changes
+
+    async def sync_async(self):
+        changes = await sheets_flight.do("sync", self.sync)
+        # Whichever caller gets here first announces, so changes from a sync a handler triggered are not lost
+        with self.unannounced_lock:
+            unannounced, self.unannounced = self.unannounced, []
+        if unannounced:
+            kyc_watcher.notify(unannounced)
+        return changes
+
+    async def run(self):
+        while keep_running.is_set():
+            try:
+                await self.sync_async()
+            except Exception as e:
+                self.error_count += 1
+                print(f"Sheet sync error: {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+    def healthy(self):
+        # Allow a couple of failed syncs before reporting the data source as down
+        if not creds or self.last_sync_at is None:
+            return False
+        return time.time() - self.last_sync_at < 3 * self.interval_seconds + 30
+
+    def stats(self):
+        return {
+            "ranges": self.ranges,
+            "last_sync_at": self.last_sync_at,
+            "last_sync_duration": self.last_sync_duration,
+            "last_changed_at": self.last_changed_at,
+            "sync_count": self.sync_count,
+            "error_count": self.error_count,
+            "interval_seconds": self.interval_seconds
+        }
+
+kyc_sync = SheetSynchronizer(kyc_index, KYC_SYNC_INTERVAL)
+
+# --- KYC Status Watcher ---
+class KycStatusWatcher:
+    def __init__(self, store):
+        self.store = store
+        self.subscribers = {}
+        self.notified = 0
+
+    def load(self):
+        # All subscribers are kept in memory so lookups never touch SQLite on the event loop
+        self.subscribers = self.store.load("kyc_subscribers")
 
-def check_kyc_status(username, member_type):
+    def subscriber(self, username):
+        return self.subscribers.get(username)
+
+    def remember(self, user, chat_id, member_type, status):
+        # Statuses are keyed by username, so users without one cannot be notified
+        if not user.username:
+            return
+        username = normalize_username(user.username)
+        record = {"chat_id": chat_id, "member_type": member_type, "verified": status["verified"]}
+        if self.subscriber(username) != record:
+            self.subscribers[username] = record
+            self.store.put("kyc_subscribers", username, record)
+
+    def notify(self, changes):
+        for member_type, username, entry in changes:
+            record = self.subscriber(username)
+            if not record or record["member_type"] != member_type or record["verified"] == entry["verified"]:
+                continue
+            text, reply_markup = render_kyc_status(username, member_type, entry)
+            outbound.send(record["chat_id"], text, priority=PRIORITY_NOTIFY, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+            record = dict(record, verified=entry["verified"])
+            self.subscribers[username] = record
+            self.store.put("kyc_subscribers", username, record)
+            self.notified += 1
+
+kyc_watcher = KycStatusWatcher(state_store)
+
+# --- KYC Sheet Writer ---
+class KycSheetWriter:
+    def __init__(self, index, interval_seconds):
+        self.index = index
+        self.interval_seconds = interval_seconds
+        self.pending = {}
+        self.flushing = {}
+        self.written = {}
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.rows_written = 0
+        self.relocated = 0
+        self.error_count = 0
+
+    def submit(self, member_type, usernames, verified, reason):
+        # Updates the index right away; the sheet catches up on the next flush
+        entry = {"verified": verified, "reason": reason or "No reason provided"}
+        updated, missing = [], []
+        for username in dict.fromkeys(normalize_username(u) for u in usernames):
+            key = (member_type, username)
+            with self.lock:
+                # Queued before touching the index, so a rebuild swapping in meanwhile still picks it up.
+                # Later edits to the same user replace earlier ones
+                self.pending[key] = (entry, reason)
+            previous = self.index.apply(username, member_type, entry)
+            if previous is None:
+                with self.lock:
+                    self.pending.pop(key, None)
+                missing.append(username)
+                continue
+            updated.append(username)
+            if previous["verified"] != verified:
+                kyc_watcher.notify([(member_type, username, entry)])
+        return updated, missing
+
+    def overrides(self, fetched_after):
+        # Edits the sheet may not reflect in a read that started at fetched_after
+        with self.lock:
+            self.written = {key: value for key, value in self.written.items() if value[1] > fetched_after}
+            edits = {key: entry for key, (entry, _) in self.written.items()}
+            edits.update((key, entry) for key, (entry, _) in self.flushing.items())
+            edits.update((key, entry) for key, (entry, _) in self.pending.items())
+        return edits
+
+    def write(self, targets):
+        # Rows come from the last sync and admins edit the sheet by hand, so check column A
+        # still holds each user before writing; returns the targets written and those that moved
+        client = get_sheets_client()
+        response = client.execute(client.values().batchGet(
+            spreadsheetId=SPREADSHEET_ID, ranges=[f"{sheet}!A{row_number}" for _, sheet, row_number, _ in targets]
+        ))
+        confirmed, moved = [], []
+        for target, value_range in zip(targets, response.get("valueRanges", [])):
+            cells = value_range.get("values", [[]])[0]
+            username = normalize_username(cells[0]) if cells else ""
+            (confirmed if username == target[0][1] else moved).append(target)
+        if confirmed:
+            client.execute(client.values().batchUpdate(spreadsheetId=SPREADSHEET_ID, body={
+                "valueInputOption": "RAW",
+                "data": [{"range": f"{sheet}!B{row_number}:C{row_number}", "values": [values]} for _, sheet, row_number, values in confirmed]
+            }))
+        return confirmed, moved
+
+    async def flush(self):
+        with self.lock:
+            if not self.pending or not creds:
+                return
+            self.flushing, self.pending = self.pending, {}
+        targets = []
+        for (member_type, username), (entry, reason) in self.flushing.items():
+            location = self.index.locate(username, member_type)
+            if location is None:
+                print(f"KYC write skipped, @{username} is no longer in the sheet")
+                continue
+            sheet_range, row_number = location
+            values = ["VERIFIED" if entry["verified"] else "REJECTED", reason]
+            targets.append(((member_type, username), sheet_range.split("!", 1)[0], row_number, values))
+        try:
+            confirmed, moved = await run_sheets_io(self.write, targets) if targets else ([], [])
+        except Exception:
+            self.error_count += 1
+            with self.lock:
+                # Keep anything edited again while the write was in flight
+                self.pending = {**self.flushing, **self.pending}
+                self.flushing = {}
+            raise
+        flushed_at = time.monotonic()
+        moved_keys = {key for key, _, _, _ in moved}
+        with self.lock:
+            for key, value in self.flushing.items():
+                if key in moved_keys:
+                    self.pending.setdefault(key, value)
+                else:
+                    self.written[key] = (value[0], flushed_at)
+            self.flushing = {}
+        if confirmed:
+            self.batches += 1
+            self.rows_written += len(confirmed)
+        if moved:
+            # Rows shifted since the last sync: re-read so the requeued edits find their new rows
+            self.relocated += len(moved)
+            await kyc_sync.sync_async()
+
+    async def run(self):
+        while keep_running.is_set():
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"KYC write error: {e}")
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "batches": self.batches,
+            "rows_written": self.rows_written,
+            "relocated": self.relocated,
+            "error_count": self.error_count,
+            "interval_seconds": self.interval_seconds
+        }
+
+kyc_writer = KycSheetWriter(kyc_index, KYC_WRITE_INTERVAL)
+
+async def check_kyc_status(username, member_type):
+    if not creds_loaded.is_set():
+        await run_sheets_io(load_credentials)
     if not creds:
         return {"verified": None, "reason": "Google Sheets not configured"}
     
-    sheet_ranges_to_check = SHEET_RANGES.get(member_type, [])
-    if not sheet_ranges_to_check:
+    if member_type not in SHEET_RANGES:
         return {"verified": False, "reason": "Invalid member type"}
 
-    try:
-        service = build("sheets", "v4", credentials=creds)
-        for sheet_range in sheet_ranges_to_check:
-            sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=sheet_range).execute()
-            values = sheet.get("values", [])
-            for row in values:
-                if len(row) > 0 and username.lower().lstrip("@") == row[0].lower().lstrip("@"):
-                    status = row[1].strip().upper() if len(row) > 1 and row[1].strip() else ""
-                    reason = row[2] if len(row) > 2 and row[2].strip() else "No reason provided"
-                    if not status:
-                        return {"verified": None, "reason": "Under review"}
-                    return {"verified": status == "VERIFIED", "reason": reason}
-        return {"verified": False, "reason": "Not found in database"}
-    except Exception as e:
-        print(f"Sheet error: {e}")
-        return {"verified": None, "reason": "Error accessing database"}
+    if not kyc_index.is_loaded(member_type):
+        try:
+            await kyc_sync.sync_async()
+        except Exception as e:
+            print(f"Sheet error: {e}")
+            return {"verified": None, "reason": "Error accessing database"}
+    return kyc_index.lookup(username, member_type)
 
-async def kyc_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    member_type = "new_member" if "_new" in query.data else "old_member"
-    user = query.from_user
-    username = user.username or f"user_{user.id}"
-    status = check_kyc_status(username, member_type)
-    
+def render_kyc_status(username, member_type, status):
     if status["verified"] is None:
         new_message = "⏳ *KYC Status*\n\nYour verification is under review.\nPlease check back later."
-        new_buttons = [
-            [InlineKeyboardButton("🔄 Refresh", callback_data=query.data)],
-            [InlineKeyboardButton("🔙 Back", callback_data="back")]
-        ]
     elif not status["verified"]:
         new_message = f"🔍 *KYC Status for* @{username}\n\n• Status: Not Verified\n• Reason: {status['reason']}\n\nPlease complete verification again"
-        new_buttons = [
-            [InlineKeyboardButton("📝 Submit Verification", url=FORM_URL)],
-            [InlineKeyboardButton("🔄 Refresh Status", callback_data=query.data)],
-            [InlineKeyboardButton("🔙 Back", callback_data="back")]
-        ]
     else:
         new_message = f"✅ *KYC Verified*\n\nCongratulations @{username}!\nYour account has been successfully verified."
-        new_buttons = [
-            [InlineKeyboardButton("💳 Proceed to Payment", callback_data=f"payment_{member_type}")],
-            [InlineKeyboardButton("🔙 Back", callback_data="back")]
-        ]
+    return new_message, KYC_STATUS_MENUS[member_type][status["verified"]]
 
+async def kyc_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    member_type = context.callback_action.member_type
+    user = query.from_user
+    username = user.username or f"user_{user.id}"
+    status = await check_kyc_status(username, member_type)
+
+    kyc_watcher.remember(user, query.message.chat_id if query.message else user.id, member_type, status)
+    new_message, reply_markup = render_kyc_status(username, member_type, status)
+    if render_cache.is_current(query, new_message, ParseMode.MARKDOWN, reply_markup):
+        # Refresh on a message already showing this status: answer locally
+        if user.username:
+            await query.answer("⏳ No change since your last check. We'll message you when it changes.")
+        else:
+            await query.answer("⏳ No change since your last check.")
+        return
+    await query.answer()
     try:
-        await query.edit_message_text(
-            text=new_message,
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup(new_buttons)
-        )
+        await render_cache.edit(query, new_message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
     except Exception as e:
         print(f"KYC check error: {e}")
-        await query.answer("⚠️ Could not update status")
 
 async def show_payment_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    
-    # Determine member type from callback data
-    member_type = "new_member" if "_new" in query.data else "old_member"
-    
-    # Select appropriate admin contact
-    admin_contact = ADMIN_USERNAME if member_type == "new_member" else ADMIN_USERNAME_2
-    
-    payment_text = (
-        "💳 *Payment Instructions*\n\n"
-        "1. Complete your KYC verification first\n"
-        "2. Payment methods available:\n"
-        "   - Cryptocurrency (USDT)\n"
-        "   - Binance\n"
-        "   - Mexc\n"
-        "3. Contact admin for payment details\n\n"
-        f"Admin: {admin_contact}"
-    )
-    
-    await query.edit_message_text(
-        text=payment_text,
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 Back", callback_data="back")]
-        ])
-    )
+    member_type = context.callback_action.member_type
+    await render_cache.edit(query, PAYMENT_INFO_TEXTS[member_type], parse_mode=ParseMode.MARKDOWN, reply_markup=BACK_MENU)
 
 async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     try:
-        # Extract full member type (new_member or old_member)
-        member_type = query.data.split('_', 1)[1]  # Splits on first underscore only
+        member_type = context.callback_action.member_type
         admin_chat_id = ADMIN_CHAT_ID if member_type == "new_member" else ADMIN_CHAT_ID_2
         
         user = query.from_user
-        secret_code = ''.join(secrets.choice('ABCDEFGHJKLMNPQRSTUVWXYZ23456789') for _ in range(8))
+        secret_code = payment_ledger.new_code(user, member_type)
         
         # Store code in user data
         context.user_data['payment_code'] = secret_code
         
         # User message
-        await query.edit_message_text(
-             text=f"✅ *Payment Verification*\n\n🔐 Your code: `{secret_code}`\n\nSend this to {ADMIN_USERNAME if member_type == 'new_member' else ADMIN_USERNAME_2}",
+        await render_cache.edit(
+             query,
+             f"✅ *Payment Verification*\n\n🔐 Your code: `{secret_code}`\n\nSend this to {admin_username_for(member_type)}",
              parse_mode=ParseMode.MARKDOWN_V2,
-             reply_markup=InlineKeyboardMarkup([
-                 [InlineKeyboardButton("🔙 Back", callback_data=f"kyc_check_{member_type.split('_')[0]}")],
-                 [InlineKeyboardButton("📞 Contact Admin", url=f"https://t.me/{(ADMIN_USERNAME if member_type == 'new_member' else ADMIN_USERNAME_2)[1:]}")]
-             ])
+             reply_markup=PAYMENT_CODE_MENUS[member_type]
         )
         
         # Admin message
-        await context.bot.send_message(
-            chat_id=admin_chat_id,
-            text=f"🆕 Payment Request from @{user.username}\n🔢 Code: `{secret_code}`\n🆔 User ID: {user.id}\n👤 Type: {member_type.replace('_', ' ')}",
+        outbound.send(
+            admin_chat_id,
+            f"🆕 Payment Request from @{user.username}\n🔢 Code: `{secret_code}`\n🆔 User ID: {user.id}\n👤 Type: {member_type.replace('_', ' ')}",
+            priority=PRIORITY_ADMIN,
             parse_mode=ParseMode.MARKDOWN_V2
         )
         
     except Exception as e:
         print(f"Payment error: {e}")
-        await query.edit_message_text(
+        await render_cache.edit(
+            query,
             "⚠️ Payment processing failed. Please try again.",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🔄 Try Again", callback_data=query.data)]
@@ -292,77 +1553,173 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 # --- Admin & Helper Functions ---
+def format_payment(record):
+    created = datetime.fromtimestamp(record["created_at"]).strftime("%Y-%m-%d %H:%M:%S")
+    username = f"@{record['username']}" if record["username"] else "(no username)"
+    return f"🔢 Code: {record['code']}\n👤 User: {username}\n🆔 User ID: {record['user_id']}\n📋 Type: {record['member_type'].replace('_', ' ')}\n🕒 Created: {created}"
+
+async def lookup_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        outbound.send(update.message.chat_id, "Usage: /lookup <code or user id>", priority=PRIORITY_ADMIN)
+        return
+    query = context.args[0]
+    # Codes can be all digits too, so they take precedence over user ids
+    record = payment_ledger.lookup(query)
+    if record is None and query.isdigit():
+        record = payment_ledger.lookup_user(int(query))
+    if record is None:
+        outbound.send(update.message.chat_id, f"❌ No active payment code for {query}", priority=PRIORITY_ADMIN)
+        return
+    outbound.send(update.message.chat_id, f"✅ Payment code found\n\n{format_payment(record)}", priority=PRIORITY_ADMIN)
+
+def parse_kyc_edit(args):
+    # <new|old> user1 user2 ... [- reason]
+    if "-" in args:
+        split = args.index("-")
+        args, reason = args[:split], " ".join(args[split + 1:])
+    else:
+        reason = ""
+    if len(args) < 2 or args[0].lower() not in ("new", "old"):
+        return None
+    return MEMBER_TYPES[args[0].lower()], args[1:], reason
+
+async def edit_kyc(update, context, verified):
+    command = "verify" if verified else "reject"
+    parsed = parse_kyc_edit(context.args)
+    if parsed is None or (not verified and not parsed[2]):
+        reason_usage = "[- reason]" if verified else "- reason"
+        outbound.send(update.message.chat_id, f"Usage: /{command} <new|old> user1 user2 ... {reason_usage}", priority=PRIORITY_ADMIN)
+        return
+    member_type, usernames, reason = parsed
+    if not kyc_index.is_loaded(member_type):
+        outbound.send(update.message.chat_id, "⚠️ KYC data is not loaded yet, try again shortly", priority=PRIORITY_ADMIN)
+        return
+    updated, missing = kyc_writer.submit(member_type, usernames, verified, reason)
+    label = "Verified" if verified else "Rejected"
+    lines = [f"{'✅' if verified else '🚫'} {label} {len(updated)} {member_type.replace('_', ' ')}(s)"]
+    if updated:
+        lines.append(", ".join(f"@{u}" for u in updated))
+    if missing:
+        lines.append(f"❓ Not found: {', '.join(f'@{u}' for u in missing)}")
+    if updated:
+        lines.append(f"📝 Sheet update queued (within {KYC_WRITE_INTERVAL}s)")
+    outbound.send(update.message.chat_id, "\n".join(lines), priority=PRIORITY_ADMIN)
+
+async def verify_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await edit_kyc(update, context, True)
+
+async def reject_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await edit_kyc(update, context, False)
+
+def notify_if_undelivered(futures, chat_id, text, **kwargs):
+    # Tells the sender once every admin copy has failed permanently
+    pending = set(futures)
+
+    def done(future):
+        pending.discard(future)
+        if not pending and all(f.cancelled() or f.exception() for f in futures):
+            outbound.send(chat_id, text, **kwargs)
+
+    for future in futures:
+        future.add_done_callback(done)
+
 async def contact_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_states[query.from_user.id] = "AWAITING_MESSAGE"
-    await query.edit_message_text("✉️ Please type your message for admin (max 500 characters):", reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("❌ Cancel", callback_data="cancel_message")]
-    ]))
+    await render_cache.edit(query, "✉️ Please type your message for admin (max 500 characters):", reply_markup=CANCEL_MESSAGE_MENU)
 
 async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     if user_id not in user_states or user_states[user_id] != "AWAITING_MESSAGE":
         return
-    if not message_limiter.check_limit(user_id):
-        await update.message.reply_text("⏳ Please wait before sending another message")
+    if not user_message_limiter.check_limit(user_id):
+        outbound.send(update.message.chat_id, "⏳ Please wait before sending another message")
         return
     message = update.message.text[:500]
+    username = update.message.from_user.username
+    # First-time senders skip the digest so new conversations are seen right away
+    first_contact = user_id not in user_messages and await asyncio.to_thread(state_store.get, "user_messages", user_id) is None
     user_messages[user_id] = message
-    admin_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📩 Reply", callback_data=f"reply_{user_id}")]])
-    try:
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"📨 New message from @{update.message.from_user.username} (ID: {user_id}):\n\n{message}", reply_markup=admin_keyboard)
-        await update.message.reply_text("✅ Your message has been sent to admin!", reply_markup=get_main_menu())
-    except Exception as e:
-        await update.message.reply_text("⚠️ Failed to send message. Please try later.")
+    outbound.send(update.message.chat_id, "✅ Your message has been queued for the admin!", reply_markup=get_main_menu())
+    futures = admin_digest.submit(
+        [ADMIN_CHAT_ID], user_id, username, message,
+        f"📨 New message from @{username} (ID: {user_id}):\n\n{message}",
+        urgent=first_contact or is_urgent(message)
+    )
+    notify_if_undelivered(futures, update.message.chat_id, "⚠️ Failed to send message. Please try later.")
     del user_states[user_id]
 
+REPLY_PROMPT = "\n\n✍️ You are now replying to "
+
+def reply_button_rows(reply_markup):
+    # Rows holding per-sender Reply buttons, without the Cancel row an active reply adds
+    rows = reply_markup.inline_keyboard if reply_markup else ()
+    return [row for row in rows if any((button.callback_data or "").startswith("reply_") for button in row)]
+
 async def admin_reply_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     if query.from_user.id not in [ADMIN_CHAT_ID, ADMIN_CHAT_ID_2]:
-        await query.edit_message_text("🚫 Admin only feature")
+        await render_cache.edit(query, "🚫 Admin only feature")
         return
     try:
-        user_id = int(query.data.split("_")[1])
+        user_id = context.callback_action.user_id
         context.user_data["replying_to"] = user_id
-        original_text = query.message.text
-        await query.edit_message_text(f"{original_text}\n\n✍️ You are now replying to this user.\nType your message below:", reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("❌ Cancel", callback_data="cancel_reply")]
-        ]))
+        # Digests carry one Reply button per sender; keep them all and name the chosen one
+        rows = reply_button_rows(query.message.reply_markup)
+        label = next((button.text for row in rows for button in row if button.callback_data == query.data), "")
+        sender = label.replace("📩 Reply", "").strip()
+        target = f"{sender} (ID: {user_id})" if sender else f"user {user_id}"
+        original_text = query.message.text.split(REPLY_PROMPT)[0]
+        await render_cache.edit(
+            query,
+            f"{original_text}{REPLY_PROMPT}{target}.\nType your message below:",
+            reply_markup=InlineKeyboardMarkup(rows + list(CANCEL_REPLY_MENU.inline_keyboard))
+        )
     except Exception as e:
-        await query.edit_message_text(f"Error: {str(e)}")
+        await render_cache.edit(query, f"Error: {str(e)}")
 
 async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id not in [ADMIN_CHAT_ID, ADMIN_CHAT_ID_2]:
         return
     if "replying_to" not in context.user_data:
-        await update.message.reply_text("⚠️ No user selected to reply to. Use the reply button from a user\\'s message.")
+        outbound.send(update.message.chat_id, "⚠️ No user selected to reply to. Use the reply button from a user\\'s message.", priority=PRIORITY_ADMIN)
         return
     user_id = context.user_data["replying_to"]
     reply_text = f"💬 Admin Reply:\n\n{update.message.text}"
-    try:
-        await context.bot.send_message(chat_id=user_id, text=reply_text, parse_mode=ParseMode.MARKDOWN)
-        await update.message.reply_text(f"✅ Reply sent to user {user_id}", reply_to_message_id=update.message.message_id)
-        log_message = f"🔷 Admin Reply Log\n\n👤 User ID: {user_id}\n🕒 Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\n📝 Message: {update.message.text}"
-        await context.bot.send_message(update.message.chat_id, log_message)
-    except Exception as e:
-        error_msg = f"⚠️ Failed to send reply to {user_id}: {str(e)}"
-        print(error_msg)
-        await update.message.reply_text(error_msg)
+    admin_message = update.message
+    sent_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def report_delivery(future):
+        # Confirmation and log go back to the admin once the user's copy is delivered
+        if future.cancelled():
+            return
+        if future.exception():
+            outbound.send(admin_message.chat_id, f"⚠️ Failed to send reply to {user_id}: {str(future.exception())}", priority=PRIORITY_ADMIN)
+            return
+        outbound.send(admin_message.chat_id, f"✅ Reply sent to user {user_id}", priority=PRIORITY_ADMIN, reply_to_message_id=admin_message.message_id)
+        log_message = f"🔷 Admin Reply Log\n\n👤 User ID: {user_id}\n🕒 Time: {sent_at}\n📝 Message: {admin_message.text}"
+        outbound.send(admin_message.chat_id, log_message, priority=PRIORITY_LOG)
+
+    outbound.send(user_id, reply_text, parse_mode=ParseMode.MARKDOWN).add_done_callback(report_delivery)
 
 async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    if not message_limiter.check_limit(user_id):
-        await update.message.reply_text("⏳ Please wait 1 minute before sending another message", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Menu", callback_data="back")]]))
+    if not forward_limiter.check_limit(user_id):
+        outbound.send(update.message.chat_id, "⏳ Please wait 1 minute before sending another message", reply_markup=BACK_TO_MENU)
         return
-    try:
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"📩 From @{update.message.from_user.username} (ID: {user_id}):\n\n{update.message.text}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📩 Reply", callback_data=f"reply_{user_id}")]]))
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID_2, text=f"📩 From @{update.message.from_user.username} (ID: {user_id}):\n\n{update.message.text}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📩 Reply", callback_data=f"reply_{user_id}")]]))
-        await update.message.reply_text("✅ Message sent to admin!", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Menu", callback_data="back")]]))
-    except Exception as e:
-        print(f"Forwarding error: {e}")
-        await update.message.reply_text("⚠️ Failed to send message. Please try again.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Menu", callback_data="back")], [InlineKeyboardButton("🔄 Try Again", callback_data="contact_admin")]]))
+    outbound.send(update.message.chat_id, "✅ Message queued for the admin!", reply_markup=BACK_TO_MENU)
+    username = update.message.from_user.username
+    futures = admin_digest.submit(
+        [ADMIN_CHAT_ID, ADMIN_CHAT_ID_2], user_id, username, update.message.text,
+        f"📩 From @{username} (ID: {user_id}):\n\n{update.message.text}",
+        urgent=is_urgent(update.message.text)
+    )
+    notify_if_undelivered(futures, update.message.chat_id, "⚠️ Failed to send message. Please try again.", reply_markup=InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 Back to Menu", callback_data="back")],
+        [InlineKeyboardButton("🔄 Try Again", callback_data="contact_admin")]
+    ]))
 
 async def cancel_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -370,34 +1727,37 @@ async def cancel_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     if user_id in user_states:
         del user_states[user_id]
-    await query.edit_message_text("❌ Message cancelled", reply_markup=get_main_menu())
+    await render_cache.edit(query, "❌ Message cancelled", reply_markup=get_main_menu())
 
 async def cancel_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    if "replying_to" in context.user_data:
-        user_id = context.user_data.pop("replying_to")
-        await query.edit_message_text(f"❌ Reply to user {user_id} cancelled", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📩 Reply Anyway", callback_data=f"reply_{user_id}")]]))
+    if "replying_to" not in context.user_data:
+        await query.answer()
+        await render_cache.edit(query, "No active reply to cancel")
+        return
+    user_id = context.user_data.pop("replying_to")
+    rows = reply_button_rows(query.message.reply_markup) if query.message else []
+    if rows:
+        # Put the message and its Reply buttons back the way they were
+        await query.answer(f"❌ Reply to user {user_id} cancelled")
+        await render_cache.edit(query, query.message.text.split(REPLY_PROMPT)[0], reply_markup=InlineKeyboardMarkup(rows))
     else:
-        await query.edit_message_text("No active reply to cancel")
+        await query.answer()
+        await render_cache.edit(query, f"❌ Reply to user {user_id} cancelled", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📩 Reply Anyway", callback_data=f"reply_{user_id}")]]))
 
 async def return_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
         await query.answer()
-        await query.edit_message_text(text="👋 Welcome back! Select an option:", reply_markup=get_main_menu())
+        await render_cache.edit(query, WELCOME_BACK_TEXT, reply_markup=get_main_menu())
     except Exception as e:
         print(f"⚠️ Menu edit failed, sending new message: {e}")
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="👋 Welcome back! Select an option:", reply_markup=get_main_menu())
+        outbound.send(update.effective_chat.id, WELCOME_BACK_TEXT, reply_markup=get_main_menu())
 
 async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    help_text = "❓ *Help Center*\n\nFor any assistance, please contact our admin team.\n\n" + f"Admin: {ADMIN_USERNAME}\n" + "We\\'re available to help you."
-    await query.edit_message_text(help_text, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("📞 Contact Admin", callback_data="contact_admin")],
-        [InlineKeyboardButton("🔙 Back", callback_data="back")]
-    ]))
+    await render_cache.edit(query, HELP_TEXT, parse_mode=ParseMode.MARKDOWN, reply_markup=HELP_MENU)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f"Error: {context.error}")
@@ -407,51 +1767,266 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await return_to_menu(update, context)
     except: pass
 
+# --- Callback Routing ---
+CallbackAction = namedtuple("CallbackAction", ["name", "member_type", "user_id"])
+MEMBER_TYPES = {"new": "new_member", "old": "old_member", "new_member": "new_member", "old_member": "old_member"}
+
+class CallbackRouter:
+    def __init__(self, routes, member_routes, user_routes):
+        # routes match callback_data exactly; the others take a member type or user id suffix
+        self.routes = routes
+        self.member_routes = member_routes
+        self.user_routes = user_routes
+        self.handlers = {name: instrumented(handler) for name, handler in {**routes, **member_routes, **user_routes}.items()}
+
+    def parse(self, data):
+        if data in self.routes:
+            return CallbackAction(data, None, None)
+        name, _, arg = data.rpartition("_")
+        if arg == "member":
+            name, _, kind = name.rpartition("_")
+            arg = f"{kind}_member"
+        if name in self.member_routes and arg in MEMBER_TYPES:
+            return CallbackAction(name, MEMBER_TYPES[arg], None)
+        if name in self.user_routes and arg.isdigit():
+            return CallbackAction(name, None, int(arg))
+        return None
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        action = self.parse(query.data or "")
+        if action is None:
+            await query.answer()
+            return
+        context.callback_action = action
+        await self.handlers[action.name](update, context)
+
+# --- Update Processing ---
+class UpdateStats:
+    def __init__(self):
+        self.queue = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, seconds):
+        self.total_wait += seconds
+        self.max_wait = max(self.max_wait, seconds)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "processed": self.processed,
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_wait": self.max_wait,
+            "concurrency_limit": CONCURRENT_UPDATES
+        }
+
+update_stats = UpdateStats()
+
+def ordering_key(update):
+    if isinstance(update, Update):
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+    return None
+
+class UpdateQueue(asyncio.Queue):
+    # PTB's fetcher turns every update it takes into a task right away, so the bound only holds
+    # if taking one waits until fewer than max_pending earlier updates are still unfinished
+    def __init__(self, maxsize, max_pending):
+        super().__init__(maxsize)
+        self.pending_slots = asyncio.Semaphore(max_pending)
+
+    async def get(self):
+        await self.pending_slots.acquire()
+        try:
+            return await super().get()
+        except BaseException:
+            self.pending_slots.release()
+            raise
+
+    def task_done(self):
+        # Called by PTB once an update has been fully processed
+        super().task_done()
+        self.pending_slots.release()
+
+class OrderedApplication(Application):
+    # PTB runs concurrent updates in any order; this keeps each user's updates in arrival order
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.update_slots = asyncio.Semaphore(CONCURRENT_UPDATES)
+        self.key_tails = {}
+
+    async def process_update(self, update):
+        key = ordering_key(update)
+        previous = self.key_tails.get(key) if key else None
+        done = asyncio.get_running_loop().create_future()
+        if key:
+            self.key_tails[key] = done
+        queued_at = time.monotonic()
+        update_stats.waiting += 1
+        started = False
+        try:
+            if previous:
+                await previous
+            async with self.update_slots:
+                started = True
+                update_stats.waiting -= 1
+                update_stats.record_wait(time.monotonic() - queued_at)
+                update_stats.in_flight += 1
+                try:
+                    await super().process_update(update)
+                finally:
+                    update_stats.in_flight -= 1
+                    update_stats.processed += 1
+        finally:
+            if not started:
+                update_stats.waiting -= 1
+            done.set_result(None)
+            if key and self.key_tails.get(key) is done:
+                del self.key_tails[key]
+
+# --- Webhook Endpoint ---
+server.config["MAX_CONTENT_LENGTH"] = WEBHOOK_MAX_BODY
+
+@server.route(WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    # Flask parses the request on its own thread; the update is handed to the bot's event loop
+    app, loop = bot_app, bot_loop
+    if app is None or loop is None or not app.running:
+        return "", 503, {"Retry-After": "5"}
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return "", 403
+    try:
+        update = Update.de_json(request.get_json(force=True), app.bot)
+    except RequestEntityTooLarge:
+        raise
+    except Exception:
+        # Malformed JSON or not an update
+        return "", 400
+    if update is None:
+        return "", 400
+    future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(app.update_queue.put(update), WEBHOOK_ENQUEUE_TIMEOUT), loop)
+    try:
+        future.result()
+    except (asyncio.TimeoutError, FuturesTimeoutError):
+        # Queue is full; Telegram redelivers the update later
+        return "", 503, {"Retry-After": "1"}
+    return "", 200
+
 # --- Application Setup ---
-async def run_telegram_bot():
-    print("🤖 Starting Telegram bot...")
-    app = Application.builder().token(BOT_TOKEN).build()
+callback_router = CallbackRouter(
+    routes={
+        "rules": show_rules,
+        "form": show_form,
+        "kyc_check_start": kyc_check_start,
+        "payment_info_start": payment_info_start,
+        "contact_admin": contact_admin,
+        "help": show_help,
+        "cancel_message": cancel_message,
+        "cancel_reply": cancel_reply,
+        "back": return_to_menu
+    },
+    member_routes={
+        "kyc_check": kyc_check,
+        "payment_info": show_payment_info,
+        "payment": handle_payment
+    },
+    user_routes={
+        "reply": admin_reply_button
+    }
+)
+
+def build_application():
+    builder = Application.builder().token(BOT_TOKEN).persistence(SQLitePersistence(state_store))
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL.rstrip('/')}/bot")
+    # At most UPDATE_QUEUE_SIZE updates are queued plus UPDATE_QUEUE_SIZE waiting or running;
+    # beyond that puts block, which pauses polling and turns into 503s for the webhook
+    builder = builder.update_queue(UpdateQueue(UPDATE_QUEUE_SIZE, UPDATE_QUEUE_SIZE))
+    builder = builder.application_class(OrderedApplication).concurrent_updates(UPDATE_QUEUE_SIZE)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    app = builder.build()
+    update_stats.queue = app.update_queue
     
-    # Command & Callback Handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(show_rules, pattern="^rules$"))
-    app.add_handler(CallbackQueryHandler(show_form, pattern="^form$"))
-    app.add_handler(CallbackQueryHandler(kyc_check_start, pattern="^kyc_check_start$"))
-    app.add_handler(CallbackQueryHandler(payment_info_start, pattern="^payment_info_start$"))
-    app.add_handler(CallbackQueryHandler(kyc_check, pattern="^kyc_check_(new|old)$"))
-    app.add_handler(CallbackQueryHandler(show_payment_info, pattern="^payment_info_(new|old)$"))
-    app.add_handler(CallbackQueryHandler(handle_payment, pattern="^payment_(new|old)$"))
-    app.add_handler(CallbackQueryHandler(handle_payment, pattern="^payment_(new_member|old_member)$"))
-    app.add_handler(CallbackQueryHandler(contact_admin, pattern="^contact_admin$"))
-    app.add_handler(CallbackQueryHandler(show_help, pattern="^help$"))
-    app.add_handler(CallbackQueryHandler(cancel_message, pattern="^cancel_message$"))
-    app.add_handler(CallbackQueryHandler(cancel_reply, pattern="^cancel_reply$"))
-    app.add_handler(CallbackQueryHandler(return_to_menu, pattern="^back$"))
-    app.add_handler(CallbackQueryHandler(admin_reply_button, pattern="^reply_"))
+    # Command & Callback Handlers (all buttons go through callback_router)
+    app.add_handler(CommandHandler("start", instrumented(start)))
+    app.add_handler(CommandHandler("lookup", instrumented(lookup_payment), filters=filters.User([ADMIN_CHAT_ID, ADMIN_CHAT_ID_2])))
+    app.add_handler(CommandHandler("verify", instrumented(verify_users), filters=filters.User([ADMIN_CHAT_ID, ADMIN_CHAT_ID_2])))
+    app.add_handler(CommandHandler("reject", instrumented(reject_users), filters=filters.User([ADMIN_CHAT_ID, ADMIN_CHAT_ID_2])))
+    app.add_handler(CallbackQueryHandler(callback_router.dispatch))
 
     # Message Handlers
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_CHAT_ID), handle_admin_reply))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_CHAT_ID_2), handle_admin_reply))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_user_message))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_CHAT_ID), instrumented(handle_admin_reply)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_CHAT_ID_2), instrumented(handle_admin_reply)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, instrumented(handle_user_message)))
 
     app.add_error_handler(error_handler)
+    return app
+
+async def warm_up_and_sync():
+    # Google imports, credential parsing and the first sheet read run after the bot is already serving
+    if not await run_sheets_io(load_credentials):
+        return
+    await run_sheets_io(get_sheets_client)
+    await kyc_sync.run()
+
+async def run_telegram_bot():
+    global bot_app, bot_loop
+    print("🤖 Starting Telegram bot...")
+    state_store.open()
+    user_states.load()
+    payment_ledger.load()
+    kyc_watcher.load()
+    app = bot_app = build_application()
+    bot_loop = asyncio.get_running_loop()
     
     await app.initialize()
     await app.start()
-    await app.updater.start_polling()
+    outbound.start(app.bot)
+    if BOT_MODE == "webhook":
+        await app.bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    else:
+        await app.updater.start_polling()
+    
+    loop_monitor_task = asyncio.create_task(loop_monitor.run())
+    kyc_sync_task = asyncio.create_task(warm_up_and_sync())
+    payment_task = asyncio.create_task(payment_ledger.run())
+    kyc_write_task = asyncio.create_task(kyc_writer.run())
     
     try:
         while keep_running.is_set():
             await asyncio.sleep(1)
     finally:
-        await app.updater.stop()
+        loop_monitor_task.cancel()
+        kyc_sync_task.cancel()
+        payment_task.cancel()
+        kyc_write_task.cancel()
+        if BOT_MODE != "webhook":
+            await app.updater.stop()
+        admin_digest.flush()
+        try:
+            # Admin edits only live in memory until written
+            await kyc_writer.flush()
+        except Exception as e:
+            print(f"KYC write error: {e}")
+        await outbound.stop()
         await app.stop()
         await app.shutdown()
+        sheets_executor.shutdown(wait=False)
+        state_store.close()
 
 def run_flask_server():
-    port = int(os.environ.get("PORT", 5000))
-    print(f"🌐 Starting Flask server on port {port}...")
-    server.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
+    print(f"🌐 Starting Flask server on port {PORT}...")
+    server.run(host="0.0.0.0", port=PORT, debug=False, use_reloader=False)
 
 def run_bot_in_thread():
     asyncio.run(run_telegram_bot())
@@ -460,10 +2035,12 @@ if __name__ == "__main__":
     if not BOT_TOKEN:
         print("❌ Error: BOT_TOKEN environment variable is required")
         exit(1)
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        print("❌ Error: WEBHOOK_URL environment variable is required in webhook mode")
+        exit(1)
     
     keep_running.set()
     flask_thread = threading.Thread(target=run_flask_server, daemon=True)
     flask_thread.start()
-    
-    print("🚀 Starting both Flask server and Telegram bot...")
+    print(f"🚀 Starting both Flask server and Telegram bot ({BOT_MODE} mode)...")
     run_bot_in_thread()